@@ -1,13 +1,22 @@
 import streamlit as st
-import pandas as pd
 from pathlib import Path
 import tempfile
 import os
-from pdf2image import convert_from_path
+import io
+import csv
+from collections import deque
+import fitz
 from vision_model import VisionProcessor
 import logging
-from PyPDF2 import PdfReader
-import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Resolution for rendered pages; the vision APIs downscale anything larger
+RENDER_DPI = 100
+
+# Columns of the results CSV and how many rows to keep for the on-screen preview
+RESULT_FIELDS = ["page_id", "cycle_id", "page_number", "text", "has_magnifier"]
+PREVIEW_ROWS = 100
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +28,11 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource
+def get_vision_processor():
+    """Build the API clients once and reuse them across Streamlit reruns"""
+    return VisionProcessor()
+
 def validate_pdf(file):
     """Validate uploaded PDF file"""
     if file is None:
@@ -40,6 +54,30 @@ def save_uploaded_file(uploaded_file):
         tmp_file.write(uploaded_file.getvalue())
         return tmp_file.name
 
+def render_pages(doc: fitz.Document, page_numbers: list, image_dir: Path) -> tuple:
+    """
+    Render missing pages to PNG in one sequential pass.
+    Returns (paths of pages available on disk, set of page numbers rendered by this call)
+    """
+    image_paths = {}
+    created = set()
+    missing = {n for n in page_numbers if not (image_dir / f"page_{n}.png").exists()}
+    for page in doc.pages(min(missing) - 1, max(missing)) if missing else []:
+        page_number = page.number + 1
+        if page_number in missing:
+            # A damaged page only skips itself; the rest of the range still renders
+            try:
+                page.get_pixmap(dpi=RENDER_DPI).save(str(image_dir / f"page_{page_number}.png"))
+                created.add(page_number)
+            except Exception as e:
+                logging.error(f"Error rendering page {page_number}: {e}")
+                st.error(f"Error rendering page {page_number}: {str(e)}")
+    for n in page_numbers:
+        image_path = image_dir / f"page_{n}.png"
+        if image_path.exists():
+            image_paths[n] = image_path
+    return image_paths, created
+
 def detect_magnifier(page_path: str, vision_processor: VisionProcessor) -> bool:
     """Detect if a page contains a magnifier symbol"""
     try:
@@ -78,9 +116,26 @@ def extract_magnifier_text(page_path: str, page_id: int, vision_processor: Visio
         st.error(f"Error extracting text: {str(e)}")
         return []
 
-def process_page(page_path: str, page_id: int, vision_processor: VisionProcessor) -> list:
-    """Process a single page and return results"""
+def process_page(page_path: str, page_id: int, vision_processor: VisionProcessor,
+                 skip_detect: bool = False, extract_executor: ThreadPoolExecutor = None) -> tuple:
+    """
+    Process a single page and return (has_magnifier, results).
+    Passing extract_executor runs extraction alongside detection.
+    """
     try:
+        if skip_detect:
+            # Extraction already returns no items on pages without a magnifier
+            page_results = extract_magnifier_text(page_path, page_id, vision_processor)
+            return bool(page_results), page_results
+        
+        if extract_executor is not None:
+            # Opt-in: issue extraction alongside detection and drop it if no
+            # magnifier was detected; pays for an extraction on every page
+            extract_future = extract_executor.submit(extract_magnifier_text, page_path, page_id, vision_processor)
+            has_magnifier = detect_magnifier(page_path, vision_processor)
+            page_results = extract_future.result()
+            return (True, page_results) if has_magnifier else (False, [])
+        
         # Check for magnifier
         has_magnifier = detect_magnifier(page_path, vision_processor)
         
@@ -88,15 +143,15 @@ def process_page(page_path: str, page_id: int, vision_processor: VisionProcessor
             # Extract text and metadata
             page_results = extract_magnifier_text(page_path, page_id, vision_processor)
             
-            return page_results
+            return True, page_results
         else:
             # Return empty list for consistency
-            return []
+            return False, []
             
     except Exception as e:
         st.error(f"Error processing page {page_id}: {str(e)}")
         # Return empty list for consistency
-        return []
+        return False, []
 
 def main():
     st.title("Magnifier Text Extractor 🔍")
@@ -143,195 +198,261 @@ def main():
         
         """)
     
-    # Create two columns for upload and preview
-    upload_col, preview_col = st.columns([1, 2])
+    doc = None
+    try:
+        # Create two columns for upload and preview
+        upload_col, preview_col = st.columns([1, 2])
     
-    # File upload in the first column
-    with upload_col:
-        st.subheader("Upload PDF")
-        uploaded_file = st.file_uploader("Choose a PDF file", type=['pdf'])
+        # File upload in the first column
+        with upload_col:
+            st.subheader("Upload PDF")
+            uploaded_file = st.file_uploader("Choose a PDF file", type=['pdf'])
         
-        if uploaded_file and validate_pdf(uploaded_file):
-            # Get filename without extension
-            filename = Path(uploaded_file.name).stem
+            if uploaded_file and validate_pdf(uploaded_file):
+                # Get filename without extension
+                filename = Path(uploaded_file.name).stem
             
-            # Create directory structure
-            base_dir = Path("data") / filename
-            image_dir = base_dir / "images"
-            image_dir.mkdir(parents=True, exist_ok=True)
+                # Create directory structure
+                base_dir = Path("data") / filename
+                image_dir = base_dir / "images"
+                image_dir.mkdir(parents=True, exist_ok=True)
             
-            try:
-                # Save uploaded file
-                pdf_path = save_uploaded_file(uploaded_file)
+                try:
+                    # Save uploaded file
+                    pdf_path = save_uploaded_file(uploaded_file)
                 
-                # Get total pages using PdfReader
-                pdf_reader = PdfReader(pdf_path)
-                total_pages = len(pdf_reader.pages)
+                    # Keep the document open so pages are rendered in-process
+                    doc = fitz.open(pdf_path)
                 
-                # Display PDF information
-                st.caption("PDF Information")
-                st.write(f"**Filename:** {filename}")
-                st.write(f"**Total pages:** {total_pages}")
+                    # Get total pages from the already-open document
+                    total_pages = doc.page_count
+                
+                    # Display PDF information
+                    st.caption("PDF Information")
+                    st.write(f"**Filename:** {filename}")
+                    st.write(f"**Total pages:** {total_pages}")
             
-            except Exception as e:
-                st.error(f"Error loading PDF: {str(e)}")
-                return
+                except Exception as e:
+                    st.error(f"Error loading PDF: {str(e)}")
+                    return
     
-    # PDF Preview in the second column
-    with preview_col:
-        if uploaded_file and validate_pdf(uploaded_file):
-            st.subheader("PDF Preview")
-            with st.expander("expand to see page"):
-                page_number = st.number_input("Page", min_value=1, max_value=total_pages, value=1)
+        # PDF Preview in the second column
+        with preview_col:
+            if uploaded_file and validate_pdf(uploaded_file):
+                st.subheader("PDF Preview")
+                with st.expander("expand to see page"):
+                    page_number = st.number_input("Page", min_value=1, max_value=total_pages, value=1)
                     
-                # Display selected page
-                try:
-                    preview_image_path = image_dir / f"page_{page_number}.png"
-                    if not preview_image_path.exists():
-                        images = convert_from_path(
-                            pdf_path,
-                            first_page=page_number,
-                            last_page=page_number,
-                            dpi=200
-                        )
-                        if images:
-                            images[0].save(str(preview_image_path))
+                    # Display selected page
+                    try:
+                        preview_image_path = image_dir / f"page_{page_number}.png"
+                        render_pages(doc, [page_number], image_dir)
                     
-                    if preview_image_path.exists():
-                        st.image(preview_image_path, width=500)
-                except Exception as e:
-                    st.error(f"Error displaying page {page_number}: {str(e)}")
-        else:
-            # If no file is uploaded, show instructions
-            st.subheader("PDF Preview")
-            st.info("Upload a PDF file to see preview here")
-            st.write("The preview will show the selected page from your PDF document.")
+                        if preview_image_path.exists():
+                            st.image(preview_image_path, width=500)
+                    except Exception as e:
+                        st.error(f"Error displaying page {page_number}: {str(e)}")
+            else:
+                # If no file is uploaded, show instructions
+                st.subheader("PDF Preview")
+                st.info("Upload a PDF file to see preview here")
+                st.write("The preview will show the selected page from your PDF document.")
     
-    # Full-width processing section (outside of columns)
-    if uploaded_file and validate_pdf(uploaded_file):
-        st.markdown("---")  # Add a separator
-        st.subheader("Processing")
+        # Full-width processing section (outside of columns)
+        if uploaded_file and validate_pdf(uploaded_file):
+            st.markdown("---")  # Add a separator
+            st.subheader("Processing")
         
-        # Add page range selection
-        st.write("### Select Page Range")
-        range_col1, range_col2 = st.columns(2)
-        with range_col1:
-            start_page = st.number_input("Start Page", min_value=1, max_value=total_pages, value=1)
-        with range_col2:
-            end_page = st.number_input("End Page", min_value=start_page, max_value=total_pages, value=total_pages)
+            # Add page range selection
+            st.write("### Select Page Range")
+            range_col1, range_col2 = st.columns(2)
+            with range_col1:
+                start_page = st.number_input("Start Page", min_value=1, max_value=total_pages, value=1)
+            with range_col2:
+                end_page = st.number_input("End Page", min_value=start_page, max_value=total_pages, value=total_pages)
+
+            # Show selected range
+            st.write(f"Selected range: Pages {start_page} to {end_page} (Total: {end_page - start_page + 1} pages)")
 
-        # Show selected range
-        st.write(f"Selected range: Pages {start_page} to {end_page} (Total: {end_page - start_page + 1} pages)")
+            # Page images rendered by a run are deleted once processed unless the user
+            # wants to keep them; pre-existing images are never touched, and re-rendered
+            # pages still hit the inference cache since it is keyed on image bytes
+            st.checkbox("Keep page images on disk", key="keep_images")
+            skip_detect = st.checkbox(
+                "Skip detect pre-pass (faster when most pages have magnifiers)",
+                key="skip_detect"
+            )
+            concurrent_extract = st.checkbox(
+                "Run detection and extraction together (lower latency, extracts every page)",
+                key="concurrent_extract",
+                disabled=skip_detect
+            )
 
-        if st.button("Process PDF"):
-            # Create progress indicators at the top
-            progress_bar = st.progress(0)
-            status_text = st.empty()
+            if st.button("Process PDF"):
+                # Create progress indicators at the top
+                progress_bar = st.progress(0)
+                status_text = st.empty()
             
-            # Create columns for image and results below the progress indicators
-            img_col, result_col = st.columns([1, 1])
+                # Create columns for image and results below the progress indicators
+                img_col, result_col = st.columns([1, 1])
             
-            # Create placeholder for current image in the first column
-            with img_col:
-                current_image_placeholder = st.empty()
+                # Create placeholder for current image in the first column
+                with img_col:
+                    current_image_placeholder = st.empty()
             
-            # Create placeholder for results in the second column
-            with result_col:
-                result_placeholder = st.empty()
+                # Create placeholder for results in the second column
+                with result_col:
+                    result_placeholder = st.empty()
             
-            # Initialize vision processor
-            vision_processor = VisionProcessor()
+                # Initialize vision processor
+                vision_processor = get_vision_processor()
             
-            # Placeholder for processing results
-            results = []
+                # Stream results straight into the CSV; only a bounded tail is kept for display
+                csv_buf = io.StringIO()
+                writer = csv.DictWriter(csv_buf, fieldnames=RESULT_FIELDS)
+                writer.writeheader()
+                preview_rows = deque(maxlen=PREVIEW_ROWS)
+                magnifier_count = 0
             
-            # Process only the selected page range
-            total_selected_pages = end_page - start_page + 1
+                # Process only the selected page range
+                total_selected_pages = end_page - start_page + 1
             
-            for i in range(start_page - 1, end_page):
-                # Update progress based on selected range
-                progress = (i - start_page + 2) / total_selected_pages
-                status_text.text(f"Processing page {i + 1}/{total_pages} ({i - start_page + 2}/{total_selected_pages})")
-                progress_bar.progress(progress)
+                def work(i, image_path):
+                    """Detect and extract magnifiers for one rendered page"""
+                    has_magnifier, page_results = process_page(
+                        str(image_path), i + 1, vision_processor, skip_detect,
+                        extract_executor if concurrent_extract else None
+                    )
+                    return i, image_path, has_magnifier, page_results
+            
+                # Pages are independent API round-trips, so overlap them in a
+                # bounded pool; workers share this run's context so st.error works
+                max_workers = min(8, total_selected_pages)
+                ctx = get_script_run_ctx()
+                # A separate pool for opt-in concurrent extraction; submitting it to the
+                # page pool could deadlock once every page worker waits on an extraction
+                with ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=lambda: add_script_run_ctx(ctx=ctx)
+                ) as extract_executor, ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=lambda: add_script_run_ctx(ctx=ctx)
+                ) as executor:
+                    futures = {}
+                    # Pages rendered by this run, the only ones that may be deleted afterwards
+                    rendered = set()
+                    # Pages complete out of order; hold finished pages until every
+                    # earlier page is written so the CSV stays in page order
+                    pending = {}
+                    next_page = start_page - 1
+                    remaining_pages = iter(range(start_page, end_page + 1))
+                    skipped = []
                 
-                # Convert page to image if needed
-                image_path = image_dir / f"page_{i+1}.png"
+                    def submit_next():
+                        """Render the next page of the range and hand it to the pool"""
+                        # fitz documents are not thread-safe so rendering stays on the main thread
+                        for page_number in remaining_pages:
+                            image_paths, created = render_pages(doc, [page_number], image_dir)
+                            rendered.update(created)
+                            if page_number in image_paths:
+                                futures[executor.submit(work, page_number - 1, image_paths[page_number])] = page_number - 1
+                                return
+                            # Unrenderable pages contribute no rows but still count as processed
+                            pending[page_number - 1] = []
+                            skipped.append(page_number)
                 
-                try:
-                    if not image_path.exists():
-                        images = convert_from_path(
-                            pdf_path,
-                            first_page=i+1,
-                            last_page=i+1,
-                            dpi=200
-                        )
-                        if images:
-                            images[0].save(str(image_path))
-                    
-                    # Display current image
-                    with img_col:
-                        current_image_placeholder.image(
-                            image_path, 
-                            caption=f"Processing page {i + 1}", 
-                            width=400
-                        )
-                    
-                    # First detect if page has magnifier
-                    has_magnifier = detect_magnifier(str(image_path), vision_processor)
-                    
-                    # Update results display with detection result
-                    with result_col:
-                        # Create a fresh container for the current page
-                        with result_placeholder.container():
-                            st.write(f"### Processing page {i + 1} of {total_pages}")
+                    # Keep only about max_workers page images on disk at a time
+                    for _ in range(max_workers):
+                        submit_next()
+                
+                    completed = 0
+                    while futures:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            page_index = futures.pop(future)
+                            completed += 1
+                        
+                            # Update progress based on selected range
+                            processed = completed + len(skipped)
+                            progress_bar.progress(processed / total_selected_pages)
+                            status_text.text(f"Processed {processed}/{total_selected_pages} pages")
+                        
+                            page_results = []
+                            try:
+                                i, image_path, has_magnifier, page_results = future.result()
                             
-                            if has_magnifier:
-                                st.write(f"✅ Magnifier detected on page {i + 1}! Extracting text...")
-                                
-                                # Extract text if magnifier is found
-                                page_results = extract_magnifier_text(str(image_path), i + 1, vision_processor)
-                                
-                                if page_results:
-                                    st.write(f"{len(page_results)} magnifiers found")
-                                    st.dataframe(page_results)
-                                    results.extend(page_results)
-                                else:
-                                    st.write("No text could be extracted")
-                            else:
-                                st.write(f"❌ No magnifiers found on page {i + 1}")
-                    
-                    # Small delay for UI updates
-                    time.sleep(1)
-                    current_image_placeholder.empty()
-                    result_placeholder.empty()
-
+                                # Display the page that just finished
+                                with img_col:
+                                    current_image_placeholder.image(
+                                        image_path, 
+                                        caption=f"Processed page {i + 1}", 
+                                        width=400
+                                    )
+                            
+                                # Update results display with detection result
+                                with result_col:
+                                    # Create a fresh container for the current page
+                                    with result_placeholder.container():
+                                        st.write(f"### Page {i + 1} of {total_pages}")
+                                    
+                                        if has_magnifier:
+                                            st.write(f"✅ Magnifier detected on page {i + 1}!")
+                                        
+                                            if page_results:
+                                                st.write(f"{len(page_results)} magnifiers found")
+                                                st.dataframe(page_results)
+                                            else:
+                                                st.write("No text could be extracted")
+                                        else:
+                                            st.write(f"❌ No magnifiers found on page {i + 1}")
 
-                except Exception as e:
-                    st.error(f"Error processing page {i + 1}: {str(e)}")
-                    continue
-                
-            # Display final results
-            st.success(f"Processing complete! Found {len(results)} magnifiers.")
+                            except Exception as e:
+                                st.error(f"Error processing page {page_index + 1}: {str(e)}")
+                        
+                            # The page has been displayed and its API calls are done
+                            if page_index + 1 in rendered and not st.session_state.get("keep_images"):
+                                try:
+                                    os.unlink(image_dir / f"page_{page_index + 1}.png")
+                                except OSError:
+                                    pass
+                        
+                            pending[page_index] = page_results
+                            while next_page in pending:
+                                rows = pending.pop(next_page)
+                                writer.writerows(rows)
+                                preview_rows.extend(rows)
+                                magnifier_count += len(rows)
+                                next_page += 1
+                        
+                            # Replace the finished page with the next one in the range
+                            submit_next()
+            
+                # Display final results
+                st.success(f"Processing complete! Found {magnifier_count} magnifiers.")
                 
-            # Display all results in a collapsible section
-            st.subheader("View Results")
-            if results:
-                df = pd.DataFrame(results)
-                st.dataframe(df)
+                # Display all results in a collapsible section
+                st.subheader("View Results")
+                if magnifier_count:
+                    if magnifier_count > PREVIEW_ROWS:
+                        st.caption(f"Showing the last {PREVIEW_ROWS} of {magnifier_count} rows; download the CSV for all results")
+                    st.dataframe(list(preview_rows))
                 
-                # Download button for CSV
-                csv = df.to_csv(index=False)
-                st.download_button(
-                    label="📥 Download Results as CSV",
-                    data=csv,
-                    file_name=f"{filename}_magnifier_results.csv",
-                    mime="text/csv",
-                    help="Download the complete results as a CSV file"
-                )
+                    # Download button for CSV
+                    st.download_button(
+                        label="📥 Download Results as CSV",
+                        data=csv_buf.getvalue(),
+                        file_name=f"{filename}_magnifier_results.csv",
+                        mime="text/csv",
+                        help="Download the complete results as a CSV file"
+                    )
             
-            # Clean up temporary PDF file when done
-            if 'pdf_path' in locals() and os.path.exists(pdf_path):
-                os.unlink(pdf_path)
+                # Clean up temporary PDF file when done
+                if 'pdf_path' in locals() and os.path.exists(pdf_path):
+                    os.unlink(pdf_path)
+    finally:
+        if doc is not None:
+            doc.close()
+
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,8 +1,12 @@
 import pytest
 from pathlib import Path
 import base64
+import io
+import threading
 from unittest.mock import Mock, patch, mock_open
-from src.vision_model import VisionProcessor, MagnifierItem, MagnifierPage
+from PIL import Image
+import src.vision_model as vision_model
+from src.vision_model import VisionProcessor, MagnifierItem, MagnifierPage, cached_inference
 
 # Test data
 MOCK_IMAGE_PATH = "test_image.png"
@@ -113,4 +117,149 @@ def test_extract_text_invalid_response(vision_processor, mock_image):
     with patch.object(vision_processor.openai_client.chat.completions, 'create', 
                      return_value=mock_response):
         result = vision_processor.extract_text(mock_image)
-        assert result == {"page_number": None, "text": None} 
\ No newline at end of file
+        assert result == {"page_number": None, "text": None}
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vision_model, "CACHE_DIR", tmp_path / "cache")
+    vision_model._read_cache.cache_clear()
+    yield tmp_path / "cache"
+    vision_model._read_cache.cache_clear()
+
+def test_cached_inference_hit(cache_dir, tmp_path):
+    """Test that identical images are served from the inference cache"""
+    image_path = tmp_path / "page_1.png"
+    image_path.write_bytes(MOCK_IMAGE_BYTES)
+    api_call = Mock(return_value=MagnifierPage(magnifier_items=[
+        MagnifierItem(cycle_id=1, page_number="i", text_after_symbol="test text")
+    ]))
+
+    class Processor:
+        @cached_inference(MagnifierPage)
+        def extract_text(self, image_path):
+            return api_call(image_path)
+
+    first = Processor().extract_text(str(image_path))
+    second = Processor().extract_text(str(image_path))
+    assert api_call.call_count == 1
+    assert second == first
+    assert len(list(cache_dir.glob("*.json"))) == 1
+
+def test_cached_inference_skips_errors(cache_dir, tmp_path):
+    """Test that error results are not cached"""
+    image_path = tmp_path / "page_1.png"
+    image_path.write_bytes(MOCK_IMAGE_BYTES)
+    api_call = Mock(return_value={"success": False, "error": "API Error"})
+
+    class Processor:
+        @cached_inference(bool)
+        def detect_magnifier_gemini(self, image_path):
+            return api_call(image_path)
+
+    Processor().detect_magnifier_gemini(str(image_path))
+    Processor().detect_magnifier_gemini(str(image_path))
+    assert api_call.call_count == 2
+    assert not cache_dir.exists()
+
+def test_cached_inference_unreadable_image(cache_dir, tmp_path):
+    """Test that missing or empty images bypass the cache instead of raising"""
+    empty_path = tmp_path / "empty.png"
+    empty_path.write_bytes(b"")
+    api_call = Mock(return_value=None)
+
+    class Processor:
+        @cached_inference(MagnifierPage)
+        def extract_text(self, image_path):
+            return api_call(image_path)
+
+    assert Processor().extract_text(str(empty_path)) is None
+    assert Processor().extract_text(str(tmp_path / "missing.png")) is None
+    assert api_call.call_count == 2
+    assert not cache_dir.exists()
+
+def test_encode_for_api_downscales_to_jpeg(tmp_path):
+    """Test that page images are shrunk and re-encoded as JPEG for the APIs"""
+    image_path = tmp_path / "page_1.png"
+    Image.new("RGBA", (3000, 1500), "white").save(image_path)
+
+    encoded = vision_model._encode_for_api(str(image_path), max_dim=1536)
+
+    with Image.open(io.BytesIO(base64.b64decode(encoded))) as image:
+        assert image.format == "JPEG"
+        assert image.size == (1536, 768)
+
+def test_load_b64_shares_encoding(tmp_path):
+    """Test that repeated encodes of an unchanged image reuse the cached string"""
+    image_path = tmp_path / "page_1.png"
+    Image.new("RGB", (100, 100), "white").save(image_path)
+    vision_model._b64_cache.clear()
+
+    with patch.object(vision_model, "_encode_for_api", return_value=MOCK_BASE64) as encode:
+        mtime = image_path.stat().st_mtime
+        assert vision_model._load_b64(str(image_path), mtime) == MOCK_BASE64
+        assert vision_model._load_b64(str(image_path), mtime) == MOCK_BASE64
+        vision_model._load_b64(str(image_path), mtime + 1)
+        assert encode.call_count == 2
+
+def test_load_b64_concurrent_callers_encode_once(tmp_path):
+    """Test that simultaneous callers for the same page share a single encode"""
+    image_path = tmp_path / "page_1.png"
+    Image.new("RGB", (100, 100), "white").save(image_path)
+    vision_model._b64_cache.clear()
+    mtime = image_path.stat().st_mtime
+    release = threading.Event()
+
+    def slow_encode(path):
+        release.wait(timeout=5)
+        return MOCK_BASE64
+
+    results = []
+    with patch.object(vision_model, "_encode_for_api", side_effect=slow_encode) as encode:
+        threads = [
+            threading.Thread(target=lambda: results.append(vision_model._load_b64(str(image_path), mtime)))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert encode.call_count == 1
+    assert results == [MOCK_BASE64] * 4
+
+@pytest.fixture
+def page_image(tmp_path, cache_dir):
+    """A real page image on disk, with the inference and encoding caches isolated"""
+    image_path = tmp_path / "page_1.png"
+    Image.new("RGB", (200, 300), "white").save(image_path)
+    vision_model._b64_cache.clear()
+    yield str(image_path)
+    vision_model._b64_cache.clear()
+
+def test_extract_text_json_mode(vision_processor, page_image):
+    """Test that a valid JSON-mode reply is validated into a MagnifierPage"""
+    mock_response = Mock()
+    mock_response.choices = [Mock(message=Mock(content=(
+        '{"magnifier_items": [{"cycle_id": 1, "page_number": "i", "text_after_symbol": "test text"}]}'
+    )))]
+
+    with patch.object(vision_processor.openai_client.chat.completions, 'create',
+                     return_value=mock_response) as create:
+        result = vision_processor.extract_text(page_image)
+
+    assert create.call_args.kwargs["response_format"] == {"type": "json_object"}
+    assert isinstance(result, MagnifierPage)
+    assert result.magnifier_items[0].cycle_id == 1
+    assert result.magnifier_items[0].text_after_symbol == "test text"
+
+@pytest.mark.parametrize("content", ["invalid json", '{"items": []}'])
+def test_extract_text_json_mode_invalid(vision_processor, page_image, content):
+    """Test that non-JSON or wrong-shaped replies return None"""
+    mock_response = Mock()
+    mock_response.choices = [Mock(message=Mock(content=content))]
+
+    with patch.object(vision_processor.openai_client.chat.completions, 'create',
+                     return_value=mock_response):
+        assert vision_processor.extract_text(page_image) is None
+
@@ -1,10 +1,20 @@
 import os
 import base64
+import functools
+import hashlib
+import io
+import json
 import logging
+import mmap
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List
-from openai import OpenAI
+from PIL import Image
+import httpx
+from openai import DefaultHttpxClient, OpenAI
 import google.generativeai as genai
 from dotenv import load_dotenv
 import streamlit as st
@@ -16,6 +26,102 @@ load_dotenv()
 # Configure Gemini
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+# Inference cache location; bump PROMPT_VERSION whenever a prompt or model changes
+CACHE_DIR = Path("data/.cache")
+PROMPT_VERSION = "3"
+
+@functools.lru_cache(maxsize=256)
+def _read_cache(key: str):
+    """Load a cached result from disk; misses raise and are therefore not memoized"""
+    with open(CACHE_DIR / f"{key}.json", "r") as cache_file:
+        return json.load(cache_file)
+
+def _write_cache(key: str, value) -> None:
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_DIR / f"{key}.json", "w") as cache_file:
+        json.dump(value, cache_file)
+
+def _encode_for_api(image_path: str, max_dim: int = 1536, quality: int = 85) -> str:
+    """
+    Downscale a page image and re-encode it as base64 JPEG for the vision APIs,
+    which resize large inputs server-side anyway.
+    """
+    with Image.open(image_path) as image:
+        image.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, "JPEG", quality=quality, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+# Bounded LRU of encoded pages; entries are futures so concurrent callers for
+# the same page wait on a single encode instead of each running their own
+_B64_CACHE_SIZE = 8
+_b64_cache = OrderedDict()
+_b64_lock = threading.Lock()
+
+def _load_b64(image_path: str, mtime: float) -> str:
+    """
+    Memoized _encode_for_api so the detect/extract methods share one encoding
+    per page; mtime is part of the key so rewritten images are re-encoded.
+    """
+    key = (image_path, mtime)
+    with _b64_lock:
+        future = _b64_cache.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _b64_cache[key] = Future()
+            while len(_b64_cache) > _B64_CACHE_SIZE:
+                _b64_cache.popitem(last=False)
+        else:
+            _b64_cache.move_to_end(key)
+
+    if is_owner:
+        try:
+            future.set_result(_encode_for_api(image_path))
+        except Exception as e:
+            # Don't keep failures around; the next caller retries
+            with _b64_lock:
+                if _b64_cache.get(key) is future:
+                    del _b64_cache[key]
+            future.set_exception(e)
+    return future.result()
+
+def cached_inference(result_type):
+    """
+    Cache successful results of a VisionProcessor method on disk, keyed on the
+    SHA-256 of the image bytes, the method name and PROMPT_VERSION.
+    Only results of result_type are cached, so error returns are retried.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, image_path: str):
+            try:
+                with open(image_path, "rb") as image_file:
+                    with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        digest = hashlib.sha256(mm).hexdigest()
+            except (OSError, ValueError):
+                # Missing or empty images can't be keyed; let the method report the error
+                return method(self, image_path)
+            key = f"{method.__name__}-{PROMPT_VERSION}-{digest}"
+
+            try:
+                cached = _read_cache(key)
+            except (OSError, ValueError):
+                pass
+            else:
+                if issubclass(result_type, BaseModel):
+                    return result_type.model_validate(cached)
+                return cached
+
+            result = method(self, image_path)
+            if isinstance(result, result_type):
+                try:
+                    _write_cache(key, result.model_dump() if isinstance(result, BaseModel) else result)
+                except OSError as e:
+                    logging.warning(f"Could not write inference cache: {e}")
+            return result
+        return wrapper
+    return decorator
+
 class MagnifierItem(BaseModel):
     cycle_id: int
     page_number: int | str | None
@@ -24,32 +130,43 @@ class MagnifierItem(BaseModel):
 class MagnifierPage(BaseModel):
     magnifier_items: List[MagnifierItem]
 
+# Built once at import; extract_text runs for every page
+_MAGNIFIER_PAGE_SCHEMA = MagnifierPage.model_json_schema()
+_MAGNIFIER_VALIDATOR = MagnifierPage.__pydantic_validator__
+_EXTRACT_PROMPT = (
+    "Extract the magnifier item from the page image, item by item. "
+    "if there's no magnifier item, return an empty magnifier_items list. "
+    "Respond with a JSON object matching this JSON schema: "
+    + json.dumps(_MAGNIFIER_PAGE_SCHEMA)
+)
+
 class VisionProcessor:
     def __init__(self):
-        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # One pooled HTTP/2 client shared by the OpenAI-compatible clients, so
+        # concurrent page requests reuse connections instead of new TLS handshakes
+        self._http = DefaultHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+        )
+        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=self._http)
         self.gemini_client = genai.GenerativeModel('gemini-2.0-flash')
         self.qwen_client = OpenAI(api_key=os.getenv('QWEN_API_KEY'),
-                                base_url="https://dashscope-intl.aliyuncs.com/compatible-mode/v1",)
+                                base_url="https://dashscope-intl.aliyuncs.com/compatible-mode/v1",
+                                http_client=self._http)
         
         # self.qwen2_client = genai.GenerativeModel('qwen2.5-VL-70b')
+    @cached_inference(bool)
     def detect_magnifier_gemini(self, image_path: str) -> bool:
         """
         Uses Gemini API to detect magnifier symbol in an image.
         """
         try:
-            # Load and encode the image
-            with open(image_path, "rb") as image_file:
-                image_bytes = image_file.read()
-            
-            # Convert to base64 for API
-            encoded_image = base64.b64encode(image_bytes).decode('utf-8')
-            
-            # Create a Gemini model instance
-            model = genai.GenerativeModel('gemini-2.0-flash')
+            # Load and encode the image for the API
+            encoded_image = _load_b64(image_path, os.path.getmtime(image_path))
             
             # Prepare the image for the model
             image_part = {
-                "mime_type": "image/png",
+                "mime_type": "image/jpeg",
                 "data": encoded_image
             }
             
@@ -59,7 +176,7 @@ class VisionProcessor:
             """
             
             # Generate content with the image and prompt
-            response = model.generate_content([prompt, image_part])
+            response = self.gemini_client.generate_content([prompt, image_part])
             
             # Clean up response - get only true/false
             result = response.text.strip().lower()
@@ -82,10 +199,7 @@ class VisionProcessor:
         """
         try:
             # Load and encode the image
-            with open(image_path, "rb") as image_file:
-                image_bytes = image_file.read()
-            
-            encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+            encoded_image = _load_b64(image_path, os.path.getmtime(image_path))
 
             # Create a O1 model instance
             messages = [
@@ -123,10 +237,7 @@ class VisionProcessor:
         """
         try:
             # Load and encode the image
-            with open(image_path, "rb") as image_file:
-                image_bytes = image_file.read()
-            
-            encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+            encoded_image = _load_b64(image_path, os.path.getmtime(image_path))
 
             messages = [
                 {
@@ -163,13 +274,13 @@ class VisionProcessor:
             logging.error(f"Error in detect_magnifier_o1: {str(e)}")
             return False
 
+    @cached_inference(MagnifierPage)
     def extract_text(self, image_path: str) -> dict:
         """
         Extract text and metadata from the page with magnifier using GPT-4 Vision
         """
         try:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+            base64_image = _load_b64(image_path, os.path.getmtime(image_path))
 
             messages = [
                 {
@@ -177,7 +288,7 @@ class VisionProcessor:
                     "content": [
                         {
                             "type": "text",
-                            "text": "Extract the magnifier item from the page image, item by item. if there's no magnifier item, return an empty list."
+                            "text": _EXTRACT_PROMPT
                         },
                         {
                             "type": "image_url",
@@ -188,15 +299,15 @@ class VisionProcessor:
             ]
 
             try: 
-                response = self.openai_client.beta.chat.completions.parse(
+                response = self.openai_client.chat.completions.create(
                     model="gpt-4o-2024-08-06",
                     messages=messages,
                     max_tokens=1000,
                     temperature=0.0,
-                    response_format=MagnifierPage
+                    response_format={"type": "json_object"}
                 )
 
-                return response.choices[0].message.parsed
+                return _MAGNIFIER_VALIDATOR.validate_json(response.choices[0].message.content)
             except Exception as e:
                 print(f"Error parsing LLM response: {e}")
                 return None